@@ -19,8 +19,8 @@ integer pixel or because the noise is assumed gaussian, or some error.
 How it works:
 1) Verify that there is usable signal (optional):
   - Measure median and standard deviation of background
-  - Look for connected regions with value > med + (std dev * thresh);
-    if no such regions at least 2x2 in size are found
+  - Look for pixels with value > med + (std dev * thresh);
+    if no 2x2 block of such pixels is found
     within a circle of radius rad centered at xyGuess
     then reject the field with "No stars found".
 
@@ -106,18 +106,19 @@ History:
 2008-01-12 ROwen    Added doSmooth flag to the centroid function, as suggested by Adam Ginsburg.
 2009-11-20 ROwen    Modified to use numpy.
 """
-__all__ = ['CentroidData', 'centroid',]
+__all__ = ['CentroidData', 'CentroidBatch', 'basicCentroidMulti', 'centroid',]
 
 import math
 import sys
+import threading
 import traceback
 
 import numpy
-import numpy.ma
 import scipy.ndimage
 
 from .Constants import DefThresh
 from . import ImUtil
+from .ImUtil import conditionData, conditionMask
 from . import radProf
 
 def _fmtList(alist):
@@ -131,6 +132,45 @@ _OuterRadAdd = 10   # amount to add to rad to get outerRad
 _MaxIter = 40       # max # of iterations
 _MinPixForStats = 20    # minimum # of pixels needed to measure med and std dev
 
+def _makeGridletShiftSlices():
+    """Return a dict of (ii, jj): (dest slices, source slices)
+    for shifting a 3x3 gridlet so that element [ii+1, jj+1] moves to the center.
+    """
+    def sliceTuple(begInds):
+        return tuple(slice(begInd, begInd + 3 - abs(delta)) for begInd, delta in begInds)
+
+    shiftSlices = {}
+    for ii in (-1, 0, 1):
+        for jj in (-1, 0, 1):
+            destSlices = sliceTuple([(max(0, -ii), ii), (max(0, -jj), jj)])
+            srcSlices = sliceTuple([(max(0, ii), ii), (max(0, jj), jj)])
+            shiftSlices[(ii, jj)] = (destSlices, srcSlices)
+    return shiftSlices
+_GridletShiftSlices = _makeGridletShiftSlices()
+
+# working arrays for the centroid walk gridlet; one set per thread
+_GridletArrays = threading.local()
+
+def _getGridletArrays():
+    """Return zeroed 3x3 working arrays (asymmArr, totCountsArr, totPtsArr) for the centroid walk.
+
+    The same arrays are returned by every call in a given thread,
+    so extract any values you want to keep before calling again.
+    """
+    try:
+        gridletArrays = _GridletArrays.arrays
+    except AttributeError:
+        # note: radAsymmWeighted3x3 requires these exact types
+        gridletArrays = (
+            numpy.zeros([3,3], numpy.float64),
+            numpy.zeros([3,3], numpy.float64),
+            numpy.zeros([3,3], numpy.int32),
+        )
+        _GridletArrays.arrays = gridletArrays
+    for arr in gridletArrays:
+        arr.fill(0)
+    return gridletArrays
+
 class CentroidData:
     """Centroid data, including the following fields:
 
@@ -207,6 +247,87 @@ class CentroidData:
         return "%s(%s)" % (self.__class__.__name__, ", ".join(dataList))
 
 
+class CentroidBatch:
+    """Centroid data for many stars, stored as arrays (one element or row per star).
+
+    Fields (each a numpy array whose first axis has length len(self)):
+    - isOK      bool; if False then centroiding failed
+    - nSat      number of saturated pixels; -1 if unknown
+    - rad       radius for centroid search (pix); nan if unknown
+    - xyCtr     [n,2] x,y centroid (pixels); nan if unknown
+    - xyErr     [n,2] predicted 1-sigma uncertainty in xyCtr (pixels); nan if unknown
+    - asymm     measure of asymmetry; nan if unknown
+    - pix       total number of unmasked pixels; -1 if unknown
+    - counts    total number of counts (ADU); nan if unknown
+
+    See CentroidData for more information about each field.
+    To centroid many stars and collect the results use CentroidBatch.fromList(basicCentroidMulti(...)).
+    The returned arrays are views of internal storage and are only valid until the next append.
+    """
+    # field name: (dtype, shape of one element, value used if unknown)
+    _FieldInfo = (
+        ("isOK", numpy.bool_, (), False),
+        ("nSat", numpy.int32, (), -1),
+        ("rad", numpy.float64, (), numpy.nan),
+        ("xyCtr", numpy.float64, (2,), numpy.nan),
+        ("xyErr", numpy.float64, (2,), numpy.nan),
+        ("asymm", numpy.float64, (), numpy.nan),
+        ("pix", numpy.int32, (), -1),
+        ("counts", numpy.float64, (), numpy.nan),
+    )
+    def __init__(self, initSize=16):
+        """Create an empty CentroidBatch.
+
+        Inputs:
+        - initSize  initial number of stars for which to allocate space
+        """
+        self._len = 0
+        self._arrDict = {}
+        for name, dtype, eltShape, nullVal in self._FieldInfo:
+            self._arrDict[name] = numpy.empty((max(int(initSize), 1),) + eltShape, dtype=dtype)
+
+    @classmethod
+    def fromList(cls, centroidDataList):
+        """Create a CentroidBatch from a sequence of CentroidData objects.
+        """
+        centroidDataList = list(centroidDataList)
+        batch = cls(initSize=len(centroidDataList))
+        for centroidData in centroidDataList:
+            batch.append(centroidData)
+        return batch
+
+    def append(self, centroidData):
+        """Append the data from one CentroidData object.
+        """
+        if self._len >= len(self._arrDict["isOK"]):
+            # double the storage
+            for name, arr in self._arrDict.items():
+                newArr = numpy.empty((2 * len(arr),) + arr.shape[1:], dtype=arr.dtype)
+                newArr[0:self._len] = arr[0:self._len]
+                self._arrDict[name] = newArr
+        for name, dtype, eltShape, nullVal in self._FieldInfo:
+            val = getattr(centroidData, name)
+            if val is None:
+                val = nullVal
+            self._arrDict[name][self._len] = val
+        self._len += 1
+
+    def __len__(self):
+        return self._len
+
+    def __getattr__(self, name):
+        try:
+            arrDict = self.__dict__["_arrDict"]
+        except KeyError:
+            raise AttributeError(name)
+        if name not in arrDict:
+            raise AttributeError(name)
+        return arrDict[name][0:self._len]
+
+    def __repr__(self):
+        return "%s(n=%d)" % (self.__class__.__name__, self._len)
+
+
 def basicCentroid(
     data,
     mask,
@@ -222,7 +343,7 @@ def basicCentroid(
     Inputs:
     - data      image data [i,j]
     - mask      a mask of invalid data (1 if invalid, 0 if valid); None if no mask.
-    - satMask   a maks of of saturated pixels (1 if saturated, 0 if not); None if no mask.
+    - satMask   a mask of saturated pixels (1 if saturated, 0 if not); None if no mask.
     - xyGuess   initial x,y guess for centroid
     - rad       radius of search (pixels);
                 values less than _MinRad are treated as _MinRad
@@ -247,6 +368,7 @@ def basicCentroid(
     if len(xyGuess) != 2:
         raise ValueError("initial guess=%r must have 2 elements" % (xyGuess,))
     rad = int(round(max(rad, _MinRad)))
+    radSq = rad * rad
     if verbosity > 2:
         print("basicCentroid: rounded rad=%s" % (rad,))
 
@@ -277,32 +399,57 @@ def basicCentroid(
         # OK, use this as first guess at maximum. Extract radial profiles in
         # a 3x3 gridlet about this, and walk to find minimum fitting error
         maxi, maxj = ijIndGuess
-        asymmArr = numpy.zeros([3,3], float)
-        totPtsArr = numpy.zeros([3,3], int)
-        totCountsArr = numpy.zeros([3,3], float)
+        asymmArr, totCountsArr, totPtsArr = _getGridletArrays()
+
+        # dict of (i, j) index of full frame: (asymm, totCounts, totPts),
+        # so positions revisited by the walk need not be recomputed
+        asymmCache = {}
 
         niter = 0
         while True:
             niter += 1
             if niter > _MaxIter:
-                raise RuntimeError("could not find a star in %s iterations" % (niter,))
+                msgStr = "could not find a star in %s iterations" % (niter,)
+                if verbosity > 0:
+                    print("basicCentroid failed: %s" % (msgStr,))
+                return CentroidData(
+                    isOK = False,
+                    msgStr = msgStr,
+                    rad = rad,
+                )
 
+            # fill in newly exposed elements of the gridlet from the cache, if possible
+            newIJList = []
             for i in range(3):
-                ii = maxi + i - 1
                 for j in range(3):
-                    jj = maxj + j - 1
-                    if totPtsArr[i, j] != 0:
-                        continue
-                    asymmArr[i, j], totCountsArr[i, j], totPtsArr[i, j] = radProf.radAsymmWeighted(
-                        data, mask, (ii, jj), rad, ccdInfo.bias, ccdInfo.readNoise, ccdInfo.ccdGain)
-# this version omits noise-based weighting
+                    if totPtsArr[i, j] == 0:
+                        fullIJ = (maxi + i - 1, maxj + j - 1)
+                        cachedVals = asymmCache.get(fullIJ)
+                        if cachedVals is None:
+                            newIJList.append((i, j, fullIJ))
+                        else:
+                            asymmArr[i, j], totCountsArr[i, j], totPtsArr[i, j] = cachedVals
+
+            # compute asymmetry for each element of the 3x3 gridlet whose totPts is still 0
+            # (in one call to the C code, rather than one call per element)
+            radProf.radAsymmWeighted3x3(
+                data, mask, (maxi, maxj), rad, ccdInfo.bias, ccdInfo.readNoise, ccdInfo.ccdGain,
+                asymmArr, totCountsArr, totPtsArr)
+            for i, j, fullIJ in newIJList:
+                asymmCache[fullIJ] = (asymmArr[i, j], totCountsArr[i, j], totPtsArr[i, j])
+# the following omits noise-based weighting
 # (warning: the error estimate will be invalid and chiSq will not be normalized)
-#                   asymmArr[i, j], totCountsArr[i, j], totPtsArr[i, j] = radProf.radAsymm(
-#                       data, mask, (ii, jj), rad)
-
-                    if verbosity > 3:
+#           for i in range(3):
+#               for j in range(3):
+#                   if totPtsArr[i, j] == 0:
+#                       asymmArr[i, j], totCountsArr[i, j], totPtsArr[i, j] = radProf.radAsymm(
+#                           data, mask, (maxi + i - 1, maxj + j - 1), rad)
+
+            if verbosity > 3:
+                for i in range(3):
+                    for j in range(3):
                         print("basicCentroid: ind=[%s, %s] ctr=(%s, %s) asymm=%10.1f, totPts=%s, totCounts=%s" % \
-                            (i, j, ii, jj, asymmArr[i, j], totPtsArr[i, j], totCountsArr[i, j]))
+                            (i, j, maxi + i - 1, maxj + j - 1, asymmArr[i, j], totPtsArr[i, j], totCountsArr[i, j]))
 
             # have error matrix. Find minimum
             ii, jj = scipy.ndimage.minimum_position(asymmArr)
@@ -321,13 +468,23 @@ def basicCentroid(
                 if verbosity > 2:
                     print("shift by", -ii, -jj, "to", maxi, maxj)
 
-                if ((maxi - ijIndGuess[0])**2 + (maxj - ijIndGuess[1])**2) >= rad**2:
-                    raise RuntimeError("could not find star within %r pixels" % (rad,))
-
-                # shift asymmArr and totPtsArr to minimum is in center again
-                asymmArr = scipy.ndimage.shift(asymmArr, (-ii, -jj))
-                totCountsArr = scipy.ndimage.shift(totCountsArr, (-ii, -jj))
-                totPtsArr = scipy.ndimage.shift(totPtsArr, (-ii, -jj))
+                if ((maxi - ijIndGuess[0])**2 + (maxj - ijIndGuess[1])**2) >= radSq:
+                    msgStr = "could not find star within %r pixels" % (rad,)
+                    if verbosity > 0:
+                        print("basicCentroid failed: %s" % (msgStr,))
+                    return CentroidData(
+                        isOK = False,
+                        msgStr = msgStr,
+                        rad = rad,
+                    )
+
+                # shift asymmArr, totCountsArr and totPtsArr (in place) so minimum is in center again;
+                # newly exposed elements are zeroed, so totPtsArr=0 marks them for computation
+                destSlices, srcSlices = _GridletShiftSlices[(ii, jj)]
+                for arr in (asymmArr, totCountsArr, totPtsArr):
+                    keptVals = arr[srcSlices].copy()
+                    arr.fill(0)
+                    arr[destSlices] = keptVals
             else:
                 # Have minimum. Get out and go home.
                 break
@@ -346,6 +503,19 @@ def basicCentroid(
         bi = 0.5 * (asymmArr[2, 1] - asymmArr[0, 1])
         aj = 0.5 * (asymmArr[1, 2] - 2.0*asymmArr[1, 1] + asymmArr[1, 0])
         bj = 0.5 * (asymmArr[1, 2] - asymmArr[1, 0])
+        radAsymmSigma = asymmArr[1,1]
+
+        # the fit and error estimate require a true minimum with positive asymmetry;
+        # test for that here rather than relying on an exception
+        if ai <= 0 or aj <= 0 or radAsymmSigma <= 0:
+            msgStr = "degenerate asymmetry profile"
+            if verbosity > 0:
+                print("basicCentroid failed: %s; ai=%s, aj=%s, asymm=%s" % (msgStr, ai, aj, radAsymmSigma))
+            return CentroidData(
+                isOK = False,
+                msgStr = msgStr,
+                rad = rad,
+            )
 
         di = -0.5*bi/ai
         dj = -0.5*bj/aj
@@ -362,7 +532,6 @@ def basicCentroid(
         # crude error estimate, based on measured asymmetry
         # note: I also tried using the minimum along i,j but that sometimes is negative
         # and this is already so crude that it's not likely to help
-        radAsymmSigma = asymmArr[1,1]
         iErr = math.sqrt(radAsymmSigma / ai)
         jErr = math.sqrt(radAsymmSigma / aj)
         xyErr = (jErr, iErr)
@@ -388,9 +557,11 @@ def basicCentroid(
             subSatMask = subSatMaskObj.getSubFrame()
             subCtrIJ = subSatMaskObj.subIJFromFullIJ(ctrPixIJ)
 
-            def makeDisk(i, j):
-                return ((i-subCtrIJ[0])**2 + (j-subCtrIJ[1])**2) <= rad**2
-            maybeSatPixel = numpy.fromfunction(makeDisk, subSatMask.shape)
+            # create a disk of radius rad centered on the center pixel,
+            # then reduce it (in place) to the saturated unmasked pixels in the disk
+            iArr, jArr = numpy.ogrid[0:subSatMask.shape[0], 0:subSatMask.shape[1]]
+            maybeSatPixel = ((iArr-subCtrIJ[0])**2 + (jArr-subCtrIJ[1])**2) <= radSq
+            numpy.logical_and(maybeSatPixel, subSatMask, out=maybeSatPixel)
 
             if mask is not None:
                 subMaskObj = ImUtil.subFrameCtr(
@@ -399,10 +570,10 @@ def basicCentroid(
                     xySize = (subSize, subSize),
                 )
                 subMask = subMaskObj.getSubFrame()
-                numpy.logical_and(maybeSatPixel, numpy.logical_not(subMask), maybeSatPixel)
+                # for bool arrays a > b means a and not b; this avoids a temporary array for not b
+                numpy.greater(maybeSatPixel, subMask, out=maybeSatPixel)
 
-            numpy.logical_and(subSatMask, maybeSatPixel, maybeSatPixel)
-            nSat = scipy.ndimage.sum(maybeSatPixel)
+            nSat = numpy.count_nonzero(maybeSatPixel)
 
         ctrData = CentroidData(
             isOK = True,
@@ -418,7 +589,7 @@ def basicCentroid(
             print("basicCentroid: %s" % (ctrData,))
         return ctrData
 
-    except Exception as e:
+    except (ValueError, ArithmeticError, IndexError) as e:
         if verbosity > 1:
             traceback.print_exc(file=sys.stderr)
         elif verbosity > 0:
@@ -430,6 +601,44 @@ def basicCentroid(
         )
 
 
+def basicCentroidMulti(
+    data,
+    mask,
+    satMask,
+    xyGuessList,
+    rad,
+    ccdInfo,
+    verbosity = 0,
+):
+    """Compute centroids for many stars in one image.
+
+    Inputs:
+    - data      image data [i,j]
+    - mask      a mask of invalid data (1 if invalid, 0 if valid); None if no mask.
+    - satMask   a mask of saturated pixels (1 if saturated, 0 if not); None if no mask.
+    - xyGuessList   a sequence of initial x,y guesses, one per star
+    - rad       radius of search (pixels);
+                values less than _MinRad are treated as _MinRad
+    - ccdInfo   ccd bias, gain, etc.; a PyGuide.CCDInfo object
+    - verbosity 0: no output, 1: print warnings, 2: print information,
+                3: print basic iteration info, 4: print detailed iteration info.
+
+    Returns a list of CentroidData objects, one per entry in xyGuessList
+    (see basicCentroid for details); use CentroidBatch.fromList to convert to arrays.
+
+    The data and masks are conditioned once, rather than once per star.
+    The stars are measured serially; the C extension holds the GIL,
+    so threads would not run in parallel.
+    """
+    data = conditionData(data)
+    mask = conditionMask(mask)
+    satMask = conditionMask(satMask)
+    return [
+        basicCentroid(data, mask, satMask, xyGuess, rad, ccdInfo, verbosity=verbosity)
+        for xyGuess in xyGuessList
+    ]
+
+
 def centroid(
     data,
     mask,
@@ -448,7 +657,7 @@ def centroid(
     Inputs:
     - data      image data [i,j]
     - mask      a mask of invalid data (1 if invalid, 0 if valid); None if no mask.
-    - satMask   a maks of of saturated pixels (1 if saturated, 0 if not); None if no mask.
+    - satMask   a mask of saturated pixels (1 if saturated, 0 if not); None if no mask.
     - xyGuess   initial x,y guess for centroid
     - rad       radius of search (pixels);
                 values less than _MinRad are treated as _MinRad
@@ -556,14 +765,15 @@ def checkSignal(
     if len(xyCtr) != 2:
         raise ValueError("initial guess=%r must have 2 elements" % (xyCtr,))
     rad = int(round(max(rad, _MinRad)))
+    radSq = rad * rad
 
     outerRad = rad + _OuterRadAdd
     subDataObj = ImUtil.subFrameCtr(
         data,
         xyCtr = xyCtr,
-        xySize = (outerRad, outerRad),
+        xySize = (outerRad * 2, outerRad * 2),
     )
-    subData = subDataObj.getSubFrame().astype(numpy.float32) # force type and copy
+    subData = numpy.asarray(subDataObj.getSubFrame(), dtype=numpy.float32) # force type; copy only if needed
     if subData.size < _MinPixForStats:
         if verbosity > 1:
             print("checkSignal: signalOK=False because subData.size = %d < %d = _MinPixForStats" %
@@ -577,26 +787,32 @@ def checkSignal(
         subMaskObj = ImUtil.subFrameCtr(
             mask,
             xyCtr = xyCtr,
-            xySize = (outerRad, outerRad),
+            xySize = (outerRad * 2, outerRad * 2),
         )
-        subMask = subMaskObj.getSubFrame().astype(numpy.bool_) # force type and copy
+        subMask = numpy.asarray(subMaskObj.getSubFrame(), dtype=numpy.bool_) # force type; copy only if needed
     else:
-        subMask = numpy.zeros(subData.shape, dtype=numpy.bool_)
+        subMask = None
 
     # create circleMask; a centered circle of radius rad
     # with 0s in the middle and 1s outside
-    def makeCircle(i, j):
-        return ((i-subCtrIJ[0])**2 + (j-subCtrIJ[1])**2) > rad**2
-    circleMask = numpy.fromfunction(makeCircle, subData.shape)
+    iArr, jArr = numpy.ogrid[0:subData.shape[0], 0:subData.shape[1]]
+    circleMask = ((iArr-subCtrIJ[0])**2 + (jArr-subCtrIJ[1])**2) > radSq
 
     # make a copy of the data outside a circle of radius "rad";
     # use this to compute background stats
-    bkgndPixels = numpy.extract(numpy.logical_and(circleMask, numpy.logical_not(subMask)), subData)
+    # (for bool arrays a > b means a and not b; this avoids a temporary array for not b)
+    if subMask is None:
+        bkgndPixels = subData[circleMask]
+    else:
+        bkgndPixels = subData[numpy.greater(circleMask, subMask)]
     if bkgndPixels.size < _OuterRadAdd**2:
         # too few unmasked pixels in outer region; try not masking off the star
         if verbosity > 2:
             print("checkSignal: too few good pixels in outer region; testing entire region")
-        bkgndPixels = numpy.extract(subData, numpy.logical_not(subMask))
+        if subMask is None:
+            bkgndPixels = subData.ravel()
+        else:
+            bkgndPixels = subData[numpy.logical_not(subMask)]
         if bkgndPixels.size < _MinPixForStats:
             if verbosity > 1:
                 print("checkSignal: signalOK=False because bkgndPixels.size = %d < %d = _MinPixForStats" %
@@ -609,58 +825,23 @@ def checkSignal(
     del(bkgndPixels)
 
     # median filter the inner data and look for signal > dataCut
-    dataPixels = numpy.ma.masked_array(
-        subData,
-        mask = numpy.logical_or(subMask, circleMask),
-        copy = True,
-    )
-    smoothedData = dataPixels.filled(imStats.med)
+    # (masked pixels and pixels outside the circle are replaced by the median);
+    # circleMask is no longer needed, so reuse it to hold the pixels to replace
+    if subMask is not None:
+        numpy.logical_or(subMask, circleMask, out=circleMask)
+    smoothedData = numpy.array(subData, dtype=numpy.float32)
+    numpy.copyto(smoothedData, imStats.med, where=circleMask)
     if doSmooth:
-        scipy.ndimage.median_filter(smoothedData, 3, output=smoothedData)
-    del(dataPixels)
+        ImUtil.medianFilter3x3(smoothedData, output=smoothedData)
 
-    # look for a blob of at least 2x2 adjacent pixels with smoothed value >= dataCut
+    # look for a 2x2 block of adjacent pixels with smoothed value > dataCut;
+    # eroding by a 2x2 structure leaves a pixel set for each such block
     # note: it'd be much simpler but less safe to simply test:
     #    if max(smoothedData) < dataCut: # have signal
-    shapeArry = numpy.ones((3,3))
-    labels, numElts = scipy.ndimage.label(smoothedData > imStats.dataCut, shapeArry)
-    del(smoothedData)
-    if verbosity > 2:
-        print("number of candidate blobs = %s" % (numElts,))
-    slices = scipy.ndimage.find_objects(labels)
-    for ijSlice in slices:
-        minSize = min([slc.stop - slc.start for slc in ijSlice])
-        if minSize >= 2:
-            return True, imStats
+    shapeArry = numpy.ones((2,2))
+    if scipy.ndimage.binary_erosion(smoothedData > imStats.dataCut, shapeArry).any():
+        return True, imStats
 
     if verbosity > 1:
         print("checkSignal: signalOK=False because no stars found")
     return False, imStats
-
-
-def conditionData(data):
-    """Convert dataArr to the correct type
-    such that basicCentroid can operate most efficiently on it.
-
-    Warning: does not copy the data unless necessary.
-    """
-    return conditionArr(data, desType=numpy.float32)
-
-def conditionMask(mask):
-    """Convert mask to the correct type
-    such that basicCentroid can operate most efficiently on it.
-
-    Mask is optional, so a value of None returns None.
-
-    Warning: does not copy the data unless necessary.
-    """
-    if mask is None:
-        return None
-    return conditionArr(mask, numpy.bool_)
-
-def conditionArr(arr, desType):
-    """Convert a sequence to a numpy array of the desired type.
-
-    Warning: does not copy the data unless necessary.
-    """
-    return numpy.array(arr, dtype=desType, order="C")
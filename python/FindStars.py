@@ -148,9 +148,9 @@ def findStars(
     # Condition the data and mask arrays so that centroid can operate
     # most efficiently on them (better to do it once in advance
     # rather then have centroid do it once for each star).
-    data = Centroid.conditionData(data)
-    mask = Centroid.conditionMask(mask)
-    satMask = Centroid.conditionMask(satMask)
+    data = ImUtil.conditionData(data)
+    mask = ImUtil.conditionMask(mask)
+    satMask = ImUtil.conditionMask(satMask)
 
     if doDS9:
         ds9Win = ImUtil.openDS9Win()
@@ -177,7 +177,7 @@ def findStars(
     # get a copy with the median used to fill in masked areas
     # and apply a filter to get rid of speckle
     smoothedData = maskedData.filled(imStats.med)
-    scipy.ndimage.median_filter(smoothedData, 3, output=smoothedData)
+    ImUtil.medianFilter3x3(smoothedData, output=smoothedData)
     if ds9Win and verbosity >= 2:
         ds9Win.xpaset("frame 3")
         ds9Win.showArray(smoothedData)
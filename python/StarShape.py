@@ -84,10 +84,11 @@ History:
 2008-01-12 ROwen    Fixed bug in StarShapeData.__repr__ (thanks to Adam Ginsburg).
 2009-11-20 ROwen    Modified to use numpy.
 """
-__all__ = ["StarShapeData", "starShape"]
+__all__ = ["StarShapeData", "starShape", "starShapeMulti"]
 
 import math
 import sys
+import threading
 import traceback
 import warnings
 
@@ -102,6 +103,100 @@ from . import radProf as radProfModule
 # minimum radius
 _MinRad = 3.0
 
+# relative tolerance on fwhm for the brent minimizer;
+# the fitted ampl and bkgnd are computed from fwhm, so they shift with it
+# (by up to ~1e-3 relative in fwhm and several ADU in bkgnd for a bright star)
+_FWHMTol = 1.0e-3
+
+# normalization of the seeing profile, so its peak is 1
+_SeeProfNorm = 1.0/1.1
+
+# dict of radial index array length: radius squared array; see _getRadSq
+_RadSqCache = {}
+
+def _getRadSq(nElt):
+    """Return radProfModule.radSqByRadInd(nElt) as float64, computing it only once for each nElt.
+
+    Float64 matches the seeing profile, so _seeProf need not convert it on every call.
+    The returned array is shared, so it is read-only.
+    """
+    radSq = _RadSqCache.get(nElt)
+    if radSq is None:
+        radSq = radProfModule.radSqByRadInd(nElt).astype(numpy.float64)
+        radSq.setflags(write=False)
+        _RadSqCache[nElt] = radSq
+    return radSq
+
+# dict of radius: array of trial fwhm for the grid scan; see _getFWHMArr
+_FWHMArrCache = {}
+
+def _getFWHMArr(rad):
+    """Return the array of trial fwhm for the grid scan for a given radius,
+    computing it only once for each radius.
+
+    The values start at 1 and increase by 10% per step while less than rad * 1.5.
+    The returned array is shared, so it is read-only.
+    """
+    fwhmArr = _FWHMArrCache.get(rad)
+    if fwhmArr is None:
+        fwhmList = []
+        fwhm = 1.0
+        while fwhm < rad*1.5:
+            fwhmList.append(fwhm)
+            fwhm += fwhm * 0.1
+        fwhmArr = numpy.array(fwhmList, dtype=numpy.float64)
+        fwhmArr.setflags(write=False)
+        _FWHMArrCache[rad] = fwhmArr
+    return fwhmArr
+
+# dict of (radius, radial index array length): (seeProfTable, seeProfSqTable); see _getSeeProfTables
+_SeeProfTableCache = {}
+
+def _getSeeProfTables(rad, nElt):
+    """Return the seeing profile table for the grid scan and its square,
+    computing them only once for each radius and radial index array length.
+
+    seeProfTable[ind] is the seeing profile for _getFWHMArr(rad)[ind]
+    evaluated at _getRadSq(nElt); seeProfSqTable = seeProfTable**2.
+    The returned arrays are shared, so they are read-only.
+    """
+    key = (rad, nElt)
+    tables = _SeeProfTableCache.get(key)
+    if tables is None:
+        seeProfTable = _seeProf(_getRadSq(nElt), _getFWHMArr(rad)[:, numpy.newaxis])
+        seeProfSqTable = seeProfTable**2
+        seeProfTable.setflags(write=False)
+        seeProfSqTable.setflags(write=False)
+        tables = (seeProfTable, seeProfSqTable)
+        _SeeProfTableCache[key] = tables
+    return tables
+
+# working arrays for the radial profile; one dict of array length: arrays per thread
+_ProfArrays = threading.local()
+
+def _getProfArrays(nElt):
+    """Return working arrays (radProf, var, nPts) of length nElt for the radial profile.
+
+    The same arrays are returned by every call in a given thread with the same nElt,
+    so extract any values you want to keep before calling again.
+    The arrays are not zeroed; radProfModule.radProf initializes them.
+    """
+    try:
+        arraysByLen = _ProfArrays.arraysByLen
+    except AttributeError:
+        arraysByLen = {}
+        _ProfArrays.arraysByLen = arraysByLen
+    profArrays = arraysByLen.get(nElt)
+    if profArrays is None:
+        # note: radProfModule.radProf requires these exact types
+        profArrays = (
+            numpy.zeros([nElt], numpy.float64),
+            numpy.zeros([nElt], numpy.float64),
+            numpy.zeros([nElt], numpy.int32),
+        )
+        arraysByLen[nElt] = profArrays
+    return profArrays
+
 class StarShapeData:
     """Guide star fit data
 
@@ -149,8 +244,8 @@ def starShape(
     """Fit a double gaussian profile to a star
 
     Inputs:
-    - data      a numpy array of float32 data
-    - mask      a numpy array of bool, or None if no mask (all data valid).
+    - data      a 2-d array of data; converted to a contiguous float32 array if necessary
+    - mask      a 2-d array of bool, or None if no mask (all data valid).
                 If supplied, mask must be the same shape as data
                 and elements are True for masked (invalid data).
     - xyCtr     x,y center of star; use the convention specified by
@@ -162,6 +257,10 @@ def starShape(
                 Note: there are no warnings at this time
     - doPlot    if True, output diagnostics using matplotlib
     """
+    # condition inputs for the C code; these do not copy the data unless necessary
+    data = ImUtil.conditionData(data)
+    mask = ImUtil.conditionMask(mask)
+
     if verbosity >= 2:
         print("starShape(data[%s,%s]; xyCtr=%.2f, %.2f; rad=%.1f)" % \
             (data.shape[0], data.shape[1], xyCtr[0], xyCtr[1], rad))
@@ -170,18 +269,18 @@ def starShape(
     ijCtrInd = ImUtil.ijIndFromXYPos(xyCtr)
 
     # compute offset of position from nearest pixel center
-    ijCtrFloat = ImUtil.ijPosFromXYPos(xyCtr)
-    ijOff = [abs(round(pos) - pos) for pos in ijCtrFloat]
-    offSq = ijOff[0]**2 + ijOff[1]**2
+    # (plain scalar arithmetic is much faster than numpy for two values)
+    iCtrFloat, jCtrFloat = ImUtil.ijPosFromXYPos(xyCtr)
+    iOff = abs(round(iCtrFloat) - iCtrFloat)
+    jOff = abs(round(jCtrFloat) - jCtrFloat)
+    offSq = (iOff * iOff) + (jOff * jOff)
 
     # adjust radius as required
     rad = int(round(max(rad, _MinRad)))
 
     # compute radial profile and associated data
     radIndArrLen = rad + 2 # radial index arrays need two extra points
-    radProf = numpy.zeros([radIndArrLen], numpy.float64)
-    var = numpy.zeros([radIndArrLen], numpy.float64)
-    nPts = numpy.zeros([radIndArrLen], numpy.int32)
+    radProf, var, nPts = _getProfArrays(radIndArrLen)
     radProfModule.radProf(data, mask, ijCtrInd, rad, radProf, var, nPts)
 
     # fit data
@@ -209,11 +308,44 @@ def starShape(
 
     if verbosity >= 2:
         print("starShape: ijOff=%.2f, %.2f; offSq=%.2f; rawFWHM=%.3f; corrFWHM=%.3f" % \
-            (ijOff[0], ijOff[1], offSq, rawFWHM, gsData.fwhm))
+            (iOff, jOff, offSq, rawFWHM, gsData.fwhm))
 
     return gsData
 
 
+def starShapeMulti(
+    data,
+    mask,
+    xyCtrList,
+    rad,
+    verbosity = 0,
+):
+    """Fit a double gaussian profile to each of many stars in one image
+
+    Inputs:
+    - data      a 2-d array of data
+    - mask      a 2-d array of bool, or None if no mask (all data valid);
+                see starShape for details
+    - xyCtrList a sequence of x,y star centers, e.g. the xyCtr of CentroidData objects
+    - rad       radius of data to fit (pixels);
+                values less than _MinRad are treated as _MinRad
+    - verbosity 0: no output, 1: print warnings, 2: print information, 3: print iteration info.
+
+    Returns a list of StarShapeData objects, one per entry in xyCtrList.
+
+    The data and mask are converted to the type needed by the C code once,
+    rather than once per star. The radius squared array, the grid-scan fwhm array
+    and seeing profile table, and the radial profile arrays are cached,
+    so they are computed once and shared by all stars of the same radius.
+    """
+    data = ImUtil.conditionData(data)
+    mask = ImUtil.conditionMask(mask)
+    return [
+        starShape(data, mask, xyCtr, rad, verbosity=verbosity)
+        for xyCtr in xyCtrList
+    ]
+
+
 def _fitRadProfile(radProf, var, nPts, rad, verbosity=0, doPlot=False):
     """Fit in profile space to determine the width, amplitude, and background.
 
@@ -232,16 +364,20 @@ def _fitRadProfile(radProf, var, nPts, rad, verbosity=0, doPlot=False):
         print("_fitRadProfile(radProf[%s]=%s\n, var[%s]=%s\n, nPts[%s]=%s, rad=%s)" %
             (len(radProf), radProf, len(var), var, len(nPts), nPts, rad))
 
-    radSq = radProfModule.radSqByRadInd(len(radProf))
+    # nPts is only used in floating point arithmetic from here on,
+    # so convert it once rather than in every product
+    nPts = nPts.astype(numpy.float64)
+
+    radSq = _getRadSq(len(radProf))
     totPnts = numpy.sum(nPts)
-    totCounts = numpy.sum(nPts*radProf)
+    totCounts = numpy.dot(nPts, radProf)
 
     # This radial weight is the one used by Jim Gunn and it seems to do as well
     # as anything else I tried. however, it results in a chiSq that is not normalized.
 #   radWeight = nPts
 
     # try a simple normalization
-    meanVar = numpy.sum(var) / float(numpy.sum(nPts > 1))
+    meanVar = numpy.sum(var) / float(numpy.count_nonzero(nPts > 1))
     radWeight = nPts / meanVar
 
     if doPlot:
@@ -262,37 +398,43 @@ def _fitRadProfile(radProf, var, nPts, rad, verbosity=0, doPlot=False):
         pylab.subplot(4,1,3)
         pylab.plot(radWeight)
 
+    # seeing profile array and its work array, reused by every call to _fitIter
+    seeProfArr = numpy.zeros([len(radProf)], numpy.float64)
+    seeProfWorkArr = numpy.zeros([len(radProf)], numpy.float64)
+
     def myfunc(fwhm):
-        ampl, bkgnd, chiSq, seeProf = _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm, verbosity=verbosity)
+        ampl, bkgnd, chiSq, seeProf = _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm,
+            seeProf=seeProfArr, seeProfWork=seeProfWorkArr, verbosity=verbosity)
         return chiSq
 
     # brute-force check a lot of values to find a good starting place
-    fwhmArr = []
-    fwhm = 1.0
-    while fwhm < rad*1.5:
-        fwhmArr.append(fwhm)
-        fwhm += fwhm * 0.1
+    fwhmArr = _getFWHMArr(rad)
     nTrials = len(fwhmArr)
-#   amplArr = numpy.zeros([nTrials], float)
-#   bkgndArr = numpy.zeros([nTrials], float)
-    chiSqArr = numpy.zeros([nTrials], float)
-
-    minInd = 0
-    BadChiSq = 9.9e99
-    minChiSq = BadChiSq
 
     if verbosity > 2:
         print("find bracketing values")
-    for ind in range(nTrials):
-        fwhm = fwhmArr[ind]
-        ampl, bkgnd, chiSq, seeProf = _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm)
-#       amplArr[ind] = ampl
-#       bkgndArr[ind] = bkgnd
-        chiSqArr[ind] = chiSq
 
-        if ampl > 0 and chiSq < minChiSq:
-            minChiSq = chiSq
-            minInd = ind
+    # fit all trial fwhm at once, using the same equations as _fitSeeProf
+    # but with one row per trial: seeProfTable[ind] is the profile for fwhmArr[ind]
+    seeProfTable, seeProfSqTable = _getSeeProfTables(rad, len(radProf))
+    sumSeeProfArr = numpy.dot(seeProfTable, nPts)
+    sumSeeProfSqArr = numpy.dot(seeProfSqTable, nPts)
+    sumSeeProfRadProfArr = numpy.dot(seeProfTable, nPts*radProf)
+    discArr = (totPnts * sumSeeProfSqArr) - sumSeeProfArr**2
+    amplArr = ((totPnts * sumSeeProfRadProfArr) - (totCounts * sumSeeProfArr)) / discArr
+    bkgndArr = ((sumSeeProfSqArr * totCounts) - (sumSeeProfArr * sumSeeProfRadProfArr)) / discArr
+    diffTable = radProf - (amplArr[:, numpy.newaxis] * seeProfTable)
+    diffTable -= bkgndArr[:, numpy.newaxis]
+    diffTable **= 2
+    chiSqArr = numpy.dot(diffTable, radWeight) / totPnts
+
+    # find the trial with minimum chiSq and positive amplitude (the first, if there is a tie)
+    BadChiSq = 9.9e99
+    isValidArr = numpy.logical_and(amplArr > 0, chiSqArr < BadChiSq)
+    if isValidArr.any():
+        minInd = int(numpy.argmin(numpy.where(isValidArr, chiSqArr, numpy.inf)))
+    else:
+        minInd = 0
 
     if pylab:
         pylab.subplot(4,1,4)
@@ -316,12 +458,13 @@ def _fitRadProfile(radProf, var, nPts, rad, verbosity=0, doPlot=False):
     if verbosity > 2:
         print("fwhmFirst=%0.1f; guess fwhmMin=%0.1f; fwhmLast=%0.1f" % (fwhmFirst, fwhmMin, fwhmLast))
 
-    fwhmMin = scipy.optimize.brent(myfunc, brack=fwhmBracket)
+    fwhmMin = scipy.optimize.brent(myfunc, brack=fwhmBracket, tol=_FWHMTol)
     if verbosity > 2:
         print("optimized fwhmMin=%0.1f" % (fwhmMin,))
 
     # compute final answers at fwhmMin
-    ampl, bkgnd, chiSq, seeProf = _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhmMin)
+    ampl, bkgnd, chiSq, seeProf = _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhmMin,
+        seeProf=seeProfArr, seeProfWork=seeProfWorkArr)
 
     if doPlot:
         pylab.subplot(4,1,1)
@@ -337,22 +480,39 @@ def _fitRadProfile(radProf, var, nPts, rad, verbosity=0, doPlot=False):
         chiSq = chiSq,
     )
 
-def _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm, verbosity=0):
+def _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm, seeProf=None, seeProfWork=None, verbosity=0):
+    """Fit amplitude and background for a given fwhm.
+
+    Returns ampl, bkgnd, chiSq, seeProf;
+    if seeProf (an array of float64 the same length as radSq) is supplied,
+    the seeing profile is computed in place in that array.
+    seeProfWork is an optional work array for _seeProf.
+    """
     if verbosity >= 3:
         print("_fitIter(radProf=%s, nPts=%s, radWeight=%s, radSq=%s, totPnts=%s, totCounts=%s, fwhm=%s)" %
             (radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm))
 
     # compute the seeing profile for the specified width parameter
-    seeProf = _seeProf(radSq, fwhm)
+    seeProf = _seeProf(radSq, fwhm, out=seeProf, workArr=seeProfWork)
+
+    ampl, bkgnd, chiSq = _fitSeeProf(radProf, nPts, radWeight, totPnts, totCounts, seeProf, fwhm, verbosity=verbosity)
+    return ampl, bkgnd, chiSq, seeProf
 
-    # compute sums
+def _fitSeeProf(radProf, nPts, radWeight, totPnts, totCounts, seeProf, fwhm, verbosity=0):
+    """Fit amplitude and background for a given seeing profile.
+
+    fwhm is the width of seeProf; it is only used for messages.
+
+    Returns ampl, bkgnd, chiSq
+    """
+    # compute sums; numpy.dot sums products in one pass without a temporary array
     nPtsSeeProf = nPts*seeProf # temporary array
-    sumSeeProf = numpy.sum(nPtsSeeProf)
-    sumSeeProfSq = numpy.sum(nPtsSeeProf*seeProf)
-    sumSeeProfRadProf = numpy.sum(nPtsSeeProf*radProf)
+    sumSeeProf = nPtsSeeProf.sum() # the method avoids the dispatch overhead of numpy.sum
+    sumSeeProfSq = numpy.dot(nPtsSeeProf, seeProf)
+    sumSeeProfRadProf = numpy.dot(nPtsSeeProf, radProf)
 
     if verbosity >= 3:
-        print("_fitIter sumSeeProf=%s, sumSeeProfSq=%s, totCounts=%s, sumSeeProfRadProf=%s, totPnts=%s" %
+        print("_fitSeeProf sumSeeProf=%s, sumSeeProfSq=%s, totCounts=%s, sumSeeProfRadProf=%s, totPnts=%s" %
             (sumSeeProf, sumSeeProfSq, totCounts, sumSeeProfRadProf, totPnts)
         )
 
@@ -364,27 +524,41 @@ def _fitIter(radProf, nPts, radWeight, radSq, totPnts, totCounts, fwhm, verbosit
         ampl  = ((totPnts * sumSeeProfRadProf) - (totCounts * sumSeeProf)) / disc
         bkgnd = ((sumSeeProfSq * totCounts) - (sumSeeProf * sumSeeProfRadProf)) / disc
         # diff is the weighted difference between the data and the model
-        diff = radProf - (ampl * seeProf) - bkgnd
-        chiSq = numpy.sum(radWeight * diff**2) / totPnts
+        diff = radProf - (ampl * seeProf)
+        diff -= bkgnd
+        chiSq = numpy.dot(radWeight * diff, diff) / totPnts
     except ArithmeticError as e:
-        sys.stderr.write("_fitIter failed on fwhm=%s\n" % fwhm)
+        sys.stderr.write("_fitSeeProf failed on fwhm=%s\n" % fwhm)
         traceback.print_exc(file=sys.stderr)
         raise RuntimeError("Could not compute shape: %s" % e)
 
     if verbosity >= 3:
-        print("_fitIter: ampl=%s; bkgnd=%s; fwhm=%s; chiSq=%.2f" %
+        print("_fitSeeProf: ampl=%s; bkgnd=%s; fwhm=%s; chiSq=%.2f" %
             (ampl, bkgnd, fwhm, chiSq)
         )
 
-    return ampl, bkgnd, chiSq, seeProf
+    return ampl, bkgnd, chiSq
 
-def _seeProf(radSq, fwhm):
+def _seeProf(radSq, fwhm, out=None, workArr=None):
     """Computes the predicted star profile for the given width parameter.
 
     Inputs:
     - radSq     array of radius squared values
-    - fwhm      desired fwhm
+    - fwhm      desired fwhm; if an array of shape [n,1] then the result has one row per fwhm
+    - out       array of float64 in which to put the result; if None a new array is created
+    - workArr   work array of float64 the same shape as the result; if None a new array is created
+
+    Returns the profile (out, if specified).
+    If out and workArr are both specified then no arrays are allocated.
     """
-    norm = 1.0/1.1
-    x = radSq * (-0.5 * (FWHMPerSigma / fwhm)**2)
-    return (numpy.exp(x) + (0.1*numpy.exp(0.25*x))) * norm
+    # compute (exp(x) + 0.1 exp(x/4)) * _SeeProfNorm in place, where x = radSq * -0.5 (FWHMPerSigma / fwhm)^2
+    x = numpy.multiply(radSq, -0.5 * (FWHMPerSigma / fwhm)**2, out=out)
+    if workArr is None:
+        workArr = numpy.empty_like(x)
+    numpy.multiply(x, 0.25, out=workArr)
+    numpy.exp(workArr, out=workArr)
+    workArr *= 0.1
+    numpy.exp(x, out=x)
+    x += workArr
+    x *= _SeeProfNorm
+    return x
@@ -44,6 +44,13 @@ static npy_float64 *g_radAsymm_var;
 static npy_int32 *g_radAsymm_nPts;
 static int g_radAsymm_nElt = 0;
 
+// global disk table for radProfDisk, for a disk of radius g_radDisk_rad:
+// the half-width of each row of the disk and the radial index
+// of each point in the enclosing square, in row-major order
+static int *g_radDisk_jHalf = NULL;
+static npy_int32 *g_radDisk_radInd = NULL;
+static int g_radDisk_rad = -1;
+
 #define MAX(A,B) ((A) > (B) ? (A) : (B))
 #define MIN(A,B) ((A) < (B) ? (A) : (B))
 
@@ -235,6 +242,126 @@ errorExit:
 }
 
 
+/* Py_radAsymmWeighted3x3 =====================================================
+*/
+char Py_radAsymmWeighted3x3_doc [] =
+"Compute radAsymmWeighted on a 3x3 grid of centers;\n"
+"this is the inner step of the centroid walk.\n"
+"\n"
+"Inputs (by position only):\n"
+"- data         a 2-d array [i,j] (numpy.float32)\n"
+"- mask         mask array [i,j] (bool); True for values to mask out (ignore).\n"
+"               None if no mask array.\n"
+"- ijCtr        i,j center of the grid ((int, int))\n"
+"- rad          radius of scan (int)\n"
+"- bias         ccd bias in ADU (float)\n"
+"- readNoise    read noise in e- (float)\n"
+"- ccdGain      ccd inverse gain in e-/ADU (float)\n"
+"\n"
+"Inputs and outputs (by position only):\n"
+"- asymm        radial asymmetry (see radAsymmWeighted) [3,3] (numpy.float64)\n"
+"- totCounts    the total # of counts [3,3] (numpy.float64)\n"
+"- totPts       the total # of points [3,3] (numpy.int32)\n"
+"\n"
+"Element [i,j] of the output arrays is for center (iCtr + i - 1, jCtr + j - 1).\n"
+"Only elements for which totPts is 0 are computed; the others are left alone.\n"
+"Thus you can keep the values you already know and set totPts to 0\n"
+"for the elements you want computed.\n"
+"\n"
+"Returns:\n"
+"- nComp        the number of elements computed (int)\n"
+"\n"
+"If mask is not None then it must have the same shape as data,\n"
+"else raises ValueError;\n"
+"each output array must be 3x3, contiguous and of the specified type,\n"
+"else raises ValueError.\n"
+;
+static PyObject *Py_radAsymmWeighted3x3(PyObject *dumObj, PyObject *args) {
+    PyObject *dataObj, *maskObj, *asymmObj, *totCountsObj, *totPtsObj;
+    PyArrayObject *dataArry=NULL, *maskArry=NULL, *asymmArry=NULL, *totCountsArry=NULL, *totPtsArry=NULL;
+    int iCtr, jCtr, rad, nComp;
+    double bias, readNoise, ccdGain;
+    char ModName[] = "radAsymmWeighted3x3";
+
+    if (!PyArg_ParseTuple(args, "OO(ii)idddOOO",
+            &dataObj, &maskObj, &iCtr, &jCtr, &rad, &bias, &readNoise, &ccdGain,
+            &asymmObj, &totCountsObj, &totPtsObj))
+        return NULL;
+
+    // Convert arrays to well-behaved arrays of correct type and verify
+    // These arrays MUST be decrefed before return.
+    dataArry = (PyArrayObject *)PyArray_FROM_OTF(dataObj, NPY_FLOAT32, NPY_ARRAY_IN_ARRAY);
+    if (dataArry == NULL) goto errorExit;
+    if (maskObj != Py_None) {
+        maskArry = (PyArrayObject *)PyArray_FROM_OTF(maskObj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+        if (maskArry == NULL) goto errorExit;
+    }
+    // the output arrays are also inputs, so they must not be silently copied
+    asymmArry = (PyArrayObject *)PyArray_FROM_OTF(asymmObj, NPY_FLOAT64, NPY_ARRAY_OUT_ARRAY);
+    if (asymmArry == NULL) goto errorExit;
+    totCountsArry = (PyArrayObject *)PyArray_FROM_OTF(totCountsObj, NPY_FLOAT64, NPY_ARRAY_OUT_ARRAY);
+    if (totCountsArry == NULL) goto errorExit;
+    totPtsArry = (PyArrayObject *)PyArray_FROM_OTF(totPtsObj, NPY_INT32, NPY_ARRAY_OUT_ARRAY);
+    if (totPtsArry == NULL) goto errorExit;
+    if ((PyObject *)asymmArry != asymmObj
+        || (PyObject *)totCountsArry != totCountsObj
+        || (PyObject *)totPtsArry != totPtsObj) {
+        PyErr_Format(PyExc_ValueError, "%s: output arrays must be contiguous and of the correct type", ModName);
+        goto errorExit;
+    }
+
+    // Check the input arrays
+    if (PyArray_NDIM(dataArry) != 2) {
+        PyErr_Format(PyExc_ValueError, "%s: data must be 2-dimensional", ModName);
+        goto errorExit;
+    }
+    if (maskArry && !PyArray_SAMESHAPE(dataArry, maskArry)) {
+        PyErr_Format(PyExc_ValueError, "%s: mask must be the same shape as data", ModName);
+        goto errorExit;
+    }
+    if (PyArray_SIZE(asymmArry) != 9 || PyArray_SIZE(totCountsArry) != 9 || PyArray_SIZE(totPtsArry) != 9) {
+        PyErr_Format(PyExc_ValueError, "%s: output arrays must be 3x3", ModName);
+        goto errorExit;
+    }
+
+    // Call the C code
+    nComp = radAsymmWeighted3x3(
+        PyArray_DIM(dataArry, 0), PyArray_DIM(dataArry, 1),
+        PyArray_DATA(dataArry),
+        maskArry? PyArray_DATA(maskArry): NULL,
+        iCtr, jCtr,
+        rad,
+        bias,
+        readNoise,
+        ccdGain,
+        PyArray_DATA(asymmArry),
+        PyArray_DATA(totCountsArry),
+        PyArray_DATA(totPtsArry)
+    );
+    if (nComp < 0) {
+        PyErr_Format(PyExc_ValueError, "%s failed", ModName);
+        goto errorExit;
+    }
+
+    // Done with all arrays, decref them
+    Py_XDECREF(dataArry);
+    Py_XDECREF(maskArry);
+    Py_XDECREF(asymmArry);
+    Py_XDECREF(totCountsArry);
+    Py_XDECREF(totPtsArry);
+
+    return Py_BuildValue("i", nComp);
+
+errorExit:
+    Py_XDECREF(dataArry);
+    Py_XDECREF(maskArry);
+    Py_XDECREF(asymmArry);
+    Py_XDECREF(totCountsArry);
+    Py_XDECREF(totPtsArry);
+    return NULL;
+}
+
+
 /* Py_radProf ============================================================
 */
 char Py_radProf_doc [] =
@@ -705,6 +832,76 @@ void g_radAsymm_free() {
     g_radAsymm_nElt = 0;
 }
 
+/* g_radDisk_setup ============================================================
+
+Set up the global disk table used by radProfDisk.
+
+Inputs:
+- rad   the radius of the disk
+
+The table lists the half-width of each row of a disk of radius rad
+(row iOff spans jOff = -jHalf...jHalf) and the radial index of each point
+of the enclosing square, in row-major order. Thus the radial index
+is computed once per radius, rather than once per point per profile,
+and each row of the disk can be traversed without per-point tests.
+
+If the table is already set up for this radius, leaves it alone.
+Else deallocates it, allocates anew and fills with new values.
+If there is not sufficient memory, deallocates the table.
+
+Returns 1 on success, 0 on failure (insufficient memory).
+*/
+int g_radDisk_setup(
+    int rad
+) {
+    int rowLen = 2*rad + 1;
+    int maxRadSq = rad*rad;
+    int iOff, jOff, jHalf;
+
+    if (g_radDisk_rad == rad) {
+        return 1;
+    }
+
+    g_radDisk_free();
+
+    if (!g_radProf_setup(rad)) {
+        return 0;
+    }
+
+    g_radDisk_jHalf = calloc(rowLen, sizeof *g_radDisk_jHalf);
+    g_radDisk_radInd = calloc(rowLen * rowLen, sizeof *g_radDisk_radInd);
+    if (g_radDisk_jHalf == NULL || g_radDisk_radInd == NULL) {
+        g_radDisk_free();
+        return 0;
+    }
+
+    for (iOff = -rad; iOff <= rad; ++iOff) {
+        jHalf = 0;
+        while ((jHalf + 1)*(jHalf + 1) + iOff*iOff <= maxRadSq) {
+            ++jHalf;
+        }
+        g_radDisk_jHalf[iOff + rad] = jHalf;
+        for (jOff = -jHalf; jOff <= jHalf; ++jOff) {
+            g_radDisk_radInd[((iOff + rad) * rowLen) + jOff + rad]
+                = g_radProf_radIndByRadSq[iOff*iOff + jOff*jOff];
+        }
+    }
+    g_radDisk_rad = rad;
+    return 1;
+}
+
+/* g_radDisk_free ============================================================
+
+Free the global disk table for radProfDisk.
+*/
+void g_radDisk_free() {
+    free(g_radDisk_jHalf);
+    free(g_radDisk_radInd);
+    g_radDisk_jHalf = NULL;
+    g_radDisk_radInd = NULL;
+    g_radDisk_rad = -1;
+}
+
 /* radAsymm ============================================================
 
 Compute a measure of radial asymmetry: sum over rad of var(rad)^2 * nPts(rad).
@@ -830,12 +1027,7 @@ int radAsymmWeighted(
     double *totCountsPtr
 ) {
     int nElt = rad + 2;
-    int ind;
     int totPts;
-    int nPts;
-    double readNoiseSqADU = (readNoise * readNoise) / (ccdGain * ccdGain);
-    double pixNoiseSq;
-    double weight;
 
     // initialize outputs
     *asymmPtr = 0.0;
@@ -864,22 +1056,265 @@ int radAsymmWeighted(
         return totPts;
     }
     
+    *asymmPtr = radAsymmWeightedFromProf(
+        nElt,
+        g_radAsymm_mean,
+        g_radAsymm_var,
+        g_radAsymm_nPts,
+        bias,
+        readNoise,
+        ccdGain
+    );
+    return totPts;
+}
+
+
+/* radAsymmWeightedFromProf ==============================================
+
+Compute the weighted measure of radial asymmetry described in radAsymmWeighted
+from a radial profile.
+
+Inputs:
+- nElt              length of the profile arrays
+- mean              the mean at each radial index
+- var               the variance at each radial index
+- nPts              the # of points at each radial index
+- bias              ccd bias in ADU
+- readNoise         read noise in e-
+- ccdGain           ccd inverse gain in e-/ADU
+
+Returns:
+- asymm             radial asymmetry (see radAsymmWeighted)
+*/
+double radAsymmWeightedFromProf(
+    int nElt,
+    npy_float64 *mean,
+    npy_float64 *var,
+    npy_int32 *nPts,
+    double bias,
+    double readNoise,
+    double ccdGain
+) {
+    int ind;
+    int nPtsInd;
+    double readNoiseSqADU = (readNoise * readNoise) / (ccdGain * ccdGain);
+    double pixNoiseSq;
+    double weight;
+    double asymm = 0.0;
+
     // force bias < smallest mean value, if necessary,
     // to prevent bogus bias from really messing up the results
     for (ind = 0; ind < nElt; ++ind) {
-        if (g_radAsymm_mean[ind] < bias) bias = g_radAsymm_mean[ind];
+        if (mean[ind] < bias) bias = mean[ind];
     }
     
     // asymm = sum(std dev^2)
     for (ind = 0; ind < nElt; ++ind) {
-        nPts = g_radAsymm_nPts[ind];
-        if (nPts > 1) {
-            pixNoiseSq = readNoiseSqADU + ((g_radAsymm_mean[ind] - bias) / ccdGain);
-            weight = sqrt(2.0 * (double) (nPts - 1)) * pixNoiseSq / (double) nPts;
-            *asymmPtr += g_radAsymm_var[ind] / weight;
+        nPtsInd = nPts[ind];
+        if (nPtsInd > 1) {
+            pixNoiseSq = readNoiseSqADU + ((mean[ind] - bias) / ccdGain);
+            weight = sqrt(2.0 * (double) (nPtsInd - 1)) * pixNoiseSq / (double) nPtsInd;
+            asymm += var[ind] / weight;
         }
     }
-        
+    return asymm;
+}
+
+
+/* radAsymmWeighted3x3 ==================================================
+
+Compute radAsymmWeighted on a 3x3 grid of centers (the inner step of the centroid walk).
+
+Inputs:
+- inLenI, inLenJ    dimensions of data and mask
+- data              data array [i,j]
+- mask              mask array [i,j] (NULL if none);
+                    0 for valid values, 1 for values to ignore
+- iCtr, jCtr        i,j center of the grid
+- rad               radius of profile
+- bias              ccd bias in ADU
+- readNoise         read noise in e-
+- ccdGain           ccd inverse gain in e-/ADU
+
+Inputs and Outputs:
+- asymm             radial asymmetry [3][3] (see radAsymmWeighted)
+- totCounts         the total # of counts [3][3]
+- totPts            the total # of points [3][3]
+
+Element [i][j] is for center (iCtr + i - 1, jCtr + j - 1).
+Only elements whose totPts is 0 are computed; the others are left alone.
+
+Returns:
+- nComp             the number of elements computed; <0 on error
+
+Radial profiles are computed by radProfDisk, so the disk table
+is set up once and shared by all elements.
+
+Error Conditions:
+- If insufficient memory to generate a working array, returns -2.
+*/
+int radAsymmWeighted3x3(
+    int inLenI, int inLenJ,
+    npy_float data[inLenI][inLenJ],
+    npy_bool mask[inLenI][inLenJ],
+    int iCtr, int jCtr,
+    int rad,
+    double bias,
+    double readNoise,
+    double ccdGain,
+    npy_float64 asymm[3][3],
+    npy_float64 totCounts[3][3],
+    npy_int32 totPts[3][3]
+) {
+    int nElt = rad + 2;
+    int i, j, cellPts;
+    int nComp = 0;
+
+    // set up working arrays and disk table once for all elements
+    if (!g_radAsymm_alloc(nElt) || !g_radDisk_setup(rad)) {
+        return -2;
+    }
+
+    for (i = 0; i < 3; ++i) {
+        for (j = 0; j < 3; ++j) {
+            if (totPts[i][j] != 0) {
+                continue;
+            }
+            cellPts = radProfDisk(
+                inLenI, inLenJ,
+                data,
+                mask,
+                iCtr + i - 1, jCtr + j - 1,
+                nElt,
+                g_radAsymm_mean,
+                g_radAsymm_var,
+                g_radAsymm_nPts,
+                &totCounts[i][j]
+            );
+            asymm[i][j] = 0.0;
+            if (cellPts > 0) {
+                asymm[i][j] = radAsymmWeightedFromProf(
+                    nElt,
+                    g_radAsymm_mean,
+                    g_radAsymm_var,
+                    g_radAsymm_nPts,
+                    bias,
+                    readNoise,
+                    ccdGain
+                );
+            }
+            totPts[i][j] = cellPts;
+            ++nComp;
+        }
+    }
+    return nComp;
+}
+
+
+/* radProfDisk ============================================================
+
+Generate a radial profile as a function of radial index
+using the global disk table (see g_radDisk_setup).
+
+This gives the same result as radProf, but the caller must first call
+g_radDisk_setup with the desired radius. This is more efficient
+than radProf when computing many profiles with the same radius.
+
+Inputs:
+- inLenI, inLenJ    dimensions of data and mask
+- data              data array [i,j]
+- mask              mask array [i,j] (NULL if none);
+                    0 for valid values, 1 for values to ignore
+- iCtr, jCtr        i,j center of profile
+- outLen            length of output arrays; must be at least g_radDisk_rad + 2
+
+Outputs:
+- mean              the mean at each radial index; 0 if npts=0
+- var               the variance (stdDev^2) at each radial index; 0 if npts=0
+- nPts              the # of points at each radial index
+- totCounts         the total # of counts (floating point to avoid overflow)
+
+Returns:
+- totPts            the total # of points (sum of nPts)
+
+Points off the data array are ignored.
+Thus the center need not be on the array.
+*/
+int radProfDisk(
+    int inLenI, int inLenJ,
+    npy_float data[inLenI][inLenJ],
+    npy_bool mask[inLenI][inLenJ],
+    int iCtr, int jCtr,
+    int outLen,
+    npy_float64 *mean,
+    npy_float64 *var,
+    npy_int32 *nPts,
+    double *totCountsPtr
+) {
+    int rad = g_radDisk_rad;
+    int rowLen = 2*rad + 1;
+    int iOff, ii, jj, jBeg, jEnd, outInd;
+    int totPts;
+    double d;
+    npy_float *dataRow;
+    npy_bool *maskRow;
+    npy_int32 *radIndRow;
+
+    // initialize outputs to 0
+    totPts = 0;
+    for(outInd=0; outInd<outLen; outInd++){
+        nPts[outInd] = 0;
+        mean[outInd] = 0.0;
+        var[outInd] = 0.0;
+    }
+    *totCountsPtr = 0;
+
+    // compute sums one row of the disk at a time;
+    // each row is clipped to the data array once, so the inner loop needs no bounds tests
+    for (iOff = MAX(-rad, -iCtr); iOff <= MIN(rad, inLenI - 1 - iCtr); ++iOff) {
+        ii = iCtr + iOff;
+        jBeg = MAX(jCtr - g_radDisk_jHalf[iOff + rad], 0);
+        jEnd = MIN(jCtr + g_radDisk_jHalf[iOff + rad], inLenJ - 1);
+        dataRow = data[ii];
+        maskRow = (mask != NULL) ? mask[ii] : NULL;
+        // radIndRow[jOff] is the radial index of data[ii][jCtr + jOff]
+        radIndRow = &g_radDisk_radInd[((iOff + rad) * rowLen) + rad];
+        // separate loops with and without a mask keep the mask test out of the unmasked case
+        if (maskRow == NULL) {
+            for (jj = jBeg; jj <= jEnd; ++jj) {
+                outInd = radIndRow[jj - jCtr];
+
+                d = (double) dataRow[jj];
+                mean[outInd] += d;
+                var[outInd] += d*d;
+                nPts[outInd]++;
+                *totCountsPtr += d;
+            }
+            totPts += MAX(jEnd + 1 - jBeg, 0);
+        } else {
+            for (jj = jBeg; jj <= jEnd; ++jj) {
+                if (maskRow[jj])
+                    continue;
+                outInd = radIndRow[jj - jCtr];
+
+                d = (double) dataRow[jj];
+                mean[outInd] += d;
+                var[outInd] += d*d;
+                nPts[outInd]++;
+                *totCountsPtr += d;
+                totPts++;
+            }
+        }
+    }
+
+    /* normalize outputs */
+    for(outInd=0; outInd<outLen; outInd++) {
+        if (nPts[outInd] != 0) {
+            mean[outInd] /= nPts[outInd];
+            var[outInd] = (var[outInd]/(double)nPts[outInd]) - (mean[outInd]*mean[outInd]);
+        }
+    }
+    
     return totPts;
 }
 
@@ -1096,6 +1531,7 @@ int radSqProf(
 static PyMethodDef radProfMethods[] = {
     {"radAsymm", Py_radAsymm, METH_VARARGS, Py_radAsymm_doc},
     {"radAsymmWeighted", Py_radAsymmWeighted, METH_VARARGS, Py_radAsymmWeighted_doc},
+    {"radAsymmWeighted3x3", Py_radAsymmWeighted3x3, METH_VARARGS, Py_radAsymmWeighted3x3_doc},
     {"radProf", Py_radProf, METH_VARARGS, Py_radProf_doc},
     {"radIndByRadSq", Py_radIndByRadSq, METH_VARARGS, Py_radIndByRadSq_doc},
     {"radSqByRadInd", Py_radSqByRadInd, METH_VARARGS, Py_radSqByRadInd_doc},
@@ -20,6 +20,8 @@ extern "C" {
 
 // routines visible to Python
 static PyObject *Py_radAsymm(PyObject *dumObj, PyObject *args);
+static PyObject *Py_radAsymmWeighted(PyObject *dumObj, PyObject *args);
+static PyObject *Py_radAsymmWeighted3x3(PyObject *dumObj, PyObject *args);
 static PyObject *Py_radProf(PyObject *dumObj, PyObject *args);
 static PyObject *Py_radIndByRadSq(PyObject *dumObj, PyObject *args);
 static PyObject *Py_radSqByRadInd(PyObject *dumObj, PyObject *args);
@@ -38,6 +40,12 @@ int g_radAsymm_alloc(
 void g_radAsymm_free(
     void
 );
+int g_radDisk_setup(
+    int rad
+);
+void g_radDisk_free(
+    void
+);
 int radAsymm(
     int inLenI, int inLenJ,
     npy_float32 data[inLenI][inLenJ],
@@ -59,6 +67,28 @@ int radAsymmWeighted(
     double *asymmPtr,
     double *totCountsPtr
 );
+double radAsymmWeightedFromProf(
+    int nElt,
+    npy_float64 *mean,
+    npy_float64 *var,
+    npy_int32 *nPts,
+    double bias,
+    double readNoise,
+    double ccdGain
+);
+int radAsymmWeighted3x3(
+    int inLenI, int inLenJ,
+    npy_float32 data[inLenI][inLenJ],
+    npy_bool mask[inLenI][inLenJ],
+    int iCtr, int jCtr,
+    int rad,
+    double bias,
+    double readNoise,
+    double ccdGain,
+    npy_float64 asymm[3][3],
+    npy_float64 totCounts[3][3],
+    npy_int32 totPts[3][3]
+);
 int radProf(
     int inLenI, int inLenJ,
     npy_float32 data[inLenI][inLenJ],
@@ -71,6 +101,17 @@ int radProf(
     npy_int32 *nPts,
     double *totCountsPtr
 );
+int radProfDisk(
+    int inLenI, int inLenJ,
+    npy_float32 data[inLenI][inLenJ],
+    npy_bool mask[inLenI][inLenJ],
+    int iCtr, int jCtr,
+    int outLen,
+    npy_float64 *mean,
+    npy_float64 *var,
+    npy_int32 *nPts,
+    double *totCountsPtr
+);
 int radSqProf(
     int inLenI, int inLenJ,
     npy_float32 data[inLenI][inLenJ],
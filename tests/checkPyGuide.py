@@ -1,4 +1,5 @@
 #!/usr/bin/env python
+from __future__ import print_function
 """Check PyGuide using pychecker
 
 History:
@@ -13,4 +14,4 @@ import scipy.ndimage
 import pychecker.checker
 import PyGuide
 
-print "Done"
+print("Done")
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+from __future__ import division, print_function
+"""Compare the background statistics used by PyGuide.Centroid.checkSignal
+with those computed by older versions of checkSignal.
+
+Older versions had two problems:
+- The subframe was rad + _OuterRadAdd on a side, rather than (rad + _OuterRadAdd) * 2
+  as documented, so for rad >= _OuterRadAdd there were always too few background pixels
+  outside the circle and checkSignal fell back to using every unmasked pixel.
+- That fallback passed its arguments to numpy.extract in the wrong order,
+  so it returned mask values instead of data: med and stdDev were meaningless (0 or 1),
+  and the signal test passed even for pure noise.
+
+For each radius this prints the old and new background statistics
+and how many noise-only and faint-star images each version accepts as having signal.
+Old acceptance is computed by applying the old statistics to the current signal test.
+"""
+import numpy
+import scipy.ndimage
+import PyGuide
+from PyGuide import Centroid, ImUtil
+
+Sky = 1000      # sky level, in ADU
+CCDInfo = PyGuide.CCDInfo(
+    bias = 1000,    # image bias, in ADU
+    readNoise = 10, # read noise, in e-
+    ccdGain = 1,    # inverse ccd gain, in e-/ADU
+)
+ArrShape = (101, 101)
+Sigma = 3.0         # star sigma, in pixels
+MaskFrac = 0.05     # fraction of pixels randomly masked
+NTrials = 30
+RadList = (5, 10, 15, 20)
+AmplList = (0, 100, 150)
+
+def oldImStats(data, mask, xyCtr, rad):
+    """Return (imStats, usedFallback) computed as older versions of checkSignal did
+    """
+    rad = int(round(max(rad, Centroid._MinRad)))
+    outerRad = rad + Centroid._OuterRadAdd
+    subDataObj = ImUtil.subFrameCtr(data, xyCtr = xyCtr, xySize = (outerRad, outerRad))
+    subData = subDataObj.getSubFrame().astype(numpy.float32)
+    subMask = ImUtil.subFrameCtr(mask, xyCtr = xyCtr, xySize = (outerRad, outerRad)).getSubFrame()
+    subCtrIJ = subDataObj.subIJFromFullIJ(ImUtil.ijPosFromXYPos(xyCtr))
+    iArr, jArr = numpy.ogrid[0:subData.shape[0], 0:subData.shape[1]]
+    circleMask = ((iArr-subCtrIJ[0])**2 + (jArr-subCtrIJ[1])**2) > rad**2
+    bkgndPixels = numpy.extract(numpy.logical_and(circleMask, numpy.logical_not(subMask)), subData)
+    usedFallback = bkgndPixels.size < Centroid._OuterRadAdd**2
+    if usedFallback:
+        bkgndPixels = numpy.extract(subData, numpy.logical_not(subMask)) # the old bug
+    return ImUtil.skyStats(bkgndPixels), usedFallback
+
+def oldSignalOK(data, mask, xyCtr, rad, imStats):
+    """Apply the current signal test to data using the specified background statistics
+    """
+    subDataObj = ImUtil.subFrameCtr(data, xyCtr = xyCtr, xySize = (rad + Centroid._OuterRadAdd,) * 2)
+    subData = subDataObj.getSubFrame().astype(numpy.float32)
+    subMask = ImUtil.subFrameCtr(mask, xyCtr = xyCtr, xySize = subData.shape[::-1]).getSubFrame()
+    subCtrIJ = subDataObj.subIJFromFullIJ(ImUtil.ijPosFromXYPos(xyCtr))
+    iArr, jArr = numpy.ogrid[0:subData.shape[0], 0:subData.shape[1]]
+    circleMask = ((iArr-subCtrIJ[0])**2 + (jArr-subCtrIJ[1])**2) > rad**2
+    smoothedData = numpy.where(numpy.logical_or(subMask, circleMask), imStats.med, subData)
+    ImUtil.medianFilter3x3(smoothedData, output=smoothedData)
+    return bool(scipy.ndimage.binary_erosion(smoothedData > imStats.dataCut, numpy.ones((2,2))).any())
+
+numpy.random.seed(1)
+print("           ------------- old --------------   --------- new ---------")
+print("rad  ampl   fallback     med  stdDev  accepted      med  stdDev  accepted")
+for rad in RadList:
+    for ampl in AmplList:
+        nOldOK = 0
+        nNewOK = 0
+        nFallback = 0
+        for trial in range(NTrials):
+            xyCtr = (50 + numpy.random.uniform(), 50 + numpy.random.uniform())
+            cleanData = PyGuide.FakeData.fakeStar(ArrShape, xyCtr, Sigma, ampl)
+            data = PyGuide.FakeData.addNoise(cleanData, sky = Sky, ccdInfo = CCDInfo)
+            mask = numpy.random.uniform(size = ArrShape) < MaskFrac
+
+            oldStats, usedFallback = oldImStats(data, mask, xyCtr, rad)
+            nFallback += usedFallback
+            nOldOK += oldSignalOK(data, mask, xyCtr, rad, oldStats)
+
+            newOK, newStats = Centroid.checkSignal(data, mask, xyCtr, rad)
+            nNewOK += newOK
+        print("%3d  %4d      %2d/%2d  %6.1f  %6.1f     %2d/%2d   %6.1f  %6.1f     %2d/%2d" % (
+            rad, ampl, nFallback, NTrials, oldStats.med, oldStats.stdDev, nOldOK, NTrials,
+            newStats.med, newStats.stdDev, nNewOK, NTrials))